@@ -103,7 +103,12 @@ class CombinedLoss:
         
     def __call__(self, x, *args, **kwargs) -> torch.Tensor:
         losses = torch.stack([loss(x) for loss in self.loss_functions])
-        weights=self.combination_function(*args, **kwargs).to(x.device)
+        weights=self.combination_function(*args, **kwargs)
+        if x.is_cuda and weights.device.type == "cpu":
+            # asynchronous copy from pinned memory, so that the evolution isn't stopped at each step
+            weights = weights.pin_memory().to(x.device, non_blocking=True)
+        else:
+            weights = weights.to(x.device)
 
         # in case you just want to log the loss for each type
         if 'log_losses'in kwargs and kwargs['log_losses']==True:
@@ -1,5 +1,10 @@
-from typing import Any
+from typing import Any, List, Tuple
+import math
+import os
 import torch
+import torch.utils.checkpoint
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 import wandb
 from IPython.display import clear_output
 
@@ -12,6 +17,11 @@ class CAModel(nn.Module):
     """Base CA class, each CA class inherits from this class
     """
 
+    # Number of steps captured in the CUDA graph replayed by evolve_graphed
+    graph_steps = 32
+    # Number of steps between the updates of the region evolved by evolve with skip_dead
+    skip_dead_steps = 10
+
     def __init__(self, n_channels=16, device=None, fire_rate=0.5):
         super(CAModel, self).__init__()
 
@@ -28,6 +38,11 @@ class CAModel(nn.Module):
         # Stores losses during training
         self.losses = []
 
+        # CUDA graphs captured by evolve_graphed, one for each input shape and parameters,
+        # they share a private memory pool created at the first capture
+        self._graphs = {}
+        self._graph_pool = None
+
         self.fire_rate = fire_rate
 
         self.to(self.device)
@@ -37,7 +52,8 @@ class CAModel(nn.Module):
         pass
 
     def evolve(self, x: torch.Tensor, iters: int, angle: float = 0.,
-               step_size: float = 1.) -> torch.Tensor:
+               step_size: float = 1., dtype: torch.dtype = None,
+               skip_dead: bool = False) -> torch.Tensor:
         """Evolves the input images "x" for "iters" steps
 
         Args:
@@ -45,22 +61,147 @@ class CAModel(nn.Module):
             iters (int): Number of steps to perform
             angle (float, optional): Angle of the update. Defaults to 0..
             step_size (float, optional): Step size of the update. Defaults to 1..
+            dtype (torch.dtype, optional): Lower precision dtype to run the
+                update network in, e.g. torch.bfloat16, the CA state stays
+                in its own dtype. Defaults to None i.e. full precision.
+            skip_dead (bool, optional): Whether to evolve only the bounding box
+                of the non-empty cells, enlarged by the distance that life can
+                cover before the box is updated, every skip_dead_steps steps.
+                The empty cells outside of it stay empty, so the result is
+                the same while the dead area is not computed. Defaults to False.
 
         Returns:
             torch.Tensor: dx
         """
         self.eval()
-        with torch.no_grad():
-            x = x.to(self.device)
-            for i in range(iters):
-                x = self.forward(x, angle=angle, step_size=step_size)
+        device_type = torch.device(self.device).type
+        with torch.no_grad(), torch.autocast(device_type, dtype=dtype, enabled=dtype is not None):
+            x = x.to(self.device).contiguous(memory_format=torch.channels_last)
+            if skip_dead:
+                x = self._evolve_live_region(x, iters, angle, step_size)
+            else:
+                x = self._evolve_steps(x, iters, angle, step_size)
+
+        return x
+
+    def _evolve_live_region(self, x, iters, angle, step_size):
+        """Evolves x for iters steps computing only the region around the
+        non-empty cells, the region is updated every skip_dead_steps steps"""
+        # life spreads by at most one cell per step, the margin also keeps the
+        # wrapped edges of the region empty, as they are in the whole grid
+        margin = self.skip_dead_steps + 2
+        x = x.clone()  # the evolved regions are written back in x
+
+        for start in range(0, iters, self.skip_dead_steps):
+            occupied = (x != 0).any(dim=1).any(dim=0)
+            rows = self._live_slice(occupied.any(dim=1), margin)
+            cols = self._live_slice(occupied.any(dim=0), margin)
+            if rows is None or cols is None:
+                return x  # all the cells are empty and stay so
+
+            n_steps = min(self.skip_dead_steps, iters-start)
+            region = x[:, :, rows, cols].contiguous(memory_format=torch.channels_last)
+            x[:, :, rows, cols] = self._evolve_steps(region, n_steps, angle, step_size)
+
+        return x
+
+    @staticmethod
+    def _live_slice(occupied, margin):
+        """Returns the slice of the occupied positions enlarged by margin,
+        the whole dimension if it doesn't fit in it, None if none is occupied"""
+        positions = occupied.nonzero().flatten().tolist()
+        if len(positions) == 0:
+            return None
+        start, stop = positions[0] - margin, positions[-1] + 1 + margin
+        if start < 0 or stop > len(occupied):
+            return slice(None)
+        return slice(start, stop)
+
+    def evolve_graphed(self, x: torch.Tensor, iters: int, angle: float = 0.,
+                       step_size: float = 1., dtype: torch.dtype = None) -> torch.Tensor:
+        """Evolves the input images "x" for "iters" steps like evolve, but the
+        steps are replayed from CUDA graphs: a graph of graph_steps steps is
+        replayed as many times as it fits in iters and a graph of a single
+        step is replayed for the remaining steps. The graphs are captured the
+        first time they are needed for a given input shape, angle, step_size
+        and dtype, so any number of iters uses at most two graphs.
+        The graphs read the current weights of the CA, so they stay valid if
+        they are updated in place, e.g. by an optimizer.
+        On the CPU it falls back to evolve.
+
+        Args:
+            x (torch.Tensor): Previous CA state
+            iters (int): Number of steps to perform
+            angle (float, optional): Angle of the update. Defaults to 0..
+            step_size (float, optional): Step size of the update. Defaults to 1..
+            dtype (torch.dtype, optional): Lower precision dtype to run the
+                update network in, see evolve. The graphs are captured under
+                autocast with this dtype regardless of the autocast state of
+                the caller. Defaults to None i.e. full precision.
+
+        Returns:
+            torch.Tensor: Evolved CA state
+        """
+        if torch.device(self.device).type != "cuda":
+            return self.evolve(x, iters, angle, step_size, dtype)
+
+        self.eval()
+        x = x.to(self.device).contiguous(memory_format=torch.channels_last)
+        n_chunks, n_steps = divmod(iters, self.graph_steps)
+        for i in range(n_chunks):
+            x = self._replay_graph(x, self.graph_steps, angle, step_size, dtype)
+        for i in range(n_steps):
+            x = self._replay_graph(x, 1, angle, step_size, dtype)
+
+        # the output of a graph is overwritten by its next replay
+        return x.clone()
+
+    def _replay_graph(self, x, iters, angle, step_size, dtype):
+        """Replays the graph that evolves x for iters steps, capturing it
+        if needed, returns the static output of the graph"""
+        key = (tuple(x.shape), x.dtype, iters, float(angle), float(step_size), dtype)
+        if key not in self._graphs:
+            self._graphs[key] = self._capture_evolve(x, iters, angle, step_size, dtype)
+
+        graph, static_input, static_output = self._graphs[key]
+        static_input.copy_(x)
+        graph.replay()
+        return static_output
+
+    def _capture_evolve(self, x, iters, angle, step_size, dtype):
+        """Captures the evolution of a tensor like x in a CUDA graph, with the
+        update network run in dtype, returns the graph, its input and its output"""
+        static_input = x.clone()
+
+        with torch.no_grad(), torch.autocast("cuda", dtype=dtype, enabled=dtype is not None):
+            # a few steps before the capture, so that cuDNN chooses its algorithms
+            warmup_stream = torch.cuda.Stream(device=self.device)
+            warmup_stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(warmup_stream):
+                self._evolve_steps(static_input.clone(), 3, angle, step_size)
+            torch.cuda.current_stream().wait_stream(warmup_stream)
+
+            if self._graph_pool is None:
+                self._graph_pool = torch.cuda.graph_pool_handle()
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph, pool=self._graph_pool):
+                static_output = self._evolve_steps(static_input, iters, angle, step_size)
+
+        return graph, static_input, static_output
+
+    def _evolve_steps(self, x, iters, angle, step_size):
+        """Evolves x for iters steps"""
+        for i in range(iters):
+            x = self.forward(x, angle, step_size)
 
         return x
 
     def test_CA(self,
                 criterion: Callable[[torch.Tensor], torch.Tensor],
                 pool: torch.Tensor,
-                evolution_iters: int = 1000) -> torch.Tensor:
+                evolution_iters: int = 1000,
+                batch_size: int = None,
+                dtype: torch.dtype = None) -> torch.Tensor:
         """Evaluates the model over the given images by evolving them
             and computing the loss against the target at each iteration.
             Returns the mean loss at each iteration
@@ -69,7 +210,12 @@ class CAModel(nn.Module):
             criterion (Callable[[torch.Tensor], torch.Tensor]): Loss function
             pool (SamplePool): Sample pool from which to extract the images
             evolution_iters (int, optional): Evolution steps. Defaults to 1000.
-            batch_size (int, optional): Batch size. Defaults to 32.
+            batch_size (int, optional): Batch size, if the batch doesn't fit
+                in the GPU memory it is halved until it does.
+                Defaults to None i.e. all the images in a single batch.
+            dtype (torch.dtype, optional): Lower precision dtype to run the
+                update network in, e.g. torch.bfloat16, see evolve.
+                Defaults to None i.e. full precision.
 
         Returns:
             torch.Tensor: tensor of size (evolution_iters) 
@@ -77,12 +223,29 @@ class CAModel(nn.Module):
         """
 
         self.eval()
-
-        with torch.no_grad():
-            inputs=pool[:]
-            inputs = inputs.to(self.device)
-            evolutions_per_image = np.zeros(inputs.shape[0])
-            loss_per_step = self.loss_eval(inputs, criterion, evolution_iters, evolutions_per_image,epoch=0,log_losses=True)
+        device_type = torch.device(self.device).type
+
+        with torch.no_grad(), torch.autocast(device_type, dtype=dtype, enabled=dtype is not None):
+            images = pool[:]
+            if batch_size is None:
+                batch_size = images.shape[0]
+
+            # the largest batch that fits in memory, so that each step is a single launch
+            while True:
+                out_of_memory = False
+                try:
+                    loss_per_step = self._test_batches(criterion, images, evolution_iters, batch_size)
+                    break
+                except torch.cuda.OutOfMemoryError:
+                    if batch_size == 1:
+                        raise
+                    out_of_memory = True
+
+                # outside of the except block, so that the traceback and the
+                # tensors held by its frames are released before emptying the cache
+                if out_of_memory:
+                    torch.cuda.empty_cache()
+                    batch_size = (batch_size+1) // 2
 
             #here i remove the outliers
             not_outliers=loss_per_step.mean(dim=[0,1])<loss_per_step.mean(dim=[0,1,2])*5
@@ -90,6 +253,18 @@ class CAModel(nn.Module):
 
         return loss_per_step.mean(dim=-1).cpu().numpy()
 
+    def _test_batches(self, criterion, images, evolution_iters, batch_size):
+        """Evolves the images in batches of batch_size and returns
+        the losses at each step of all the images"""
+        losses = []
+        for start in range(0, images.shape[0], batch_size):
+            inputs = images[start:start+batch_size].to(self.device)
+            evolutions_per_image = np.zeros(inputs.shape[0])
+            losses.append(self.loss_eval(inputs, criterion, evolution_iters, evolutions_per_image,
+                                         epoch=0, log_losses=True))
+
+        return torch.cat(losses, dim=-1)
+
     def train_CA(self,
                  optimizer: torch.optim.Optimizer,
                  criterion: Callable[[torch.Tensor, Any], torch.Tensor],
@@ -101,7 +276,12 @@ class CAModel(nn.Module):
                  evolution_iters: int = 96,
                  kind: str = "growing",
                  n_max_losses: int = 1,
+                 normalize_gradients: bool = False,
                  stopping_criterion: StoppingCriteria = DefaultStopping(),
+                 mixed_precision: bool = False,
+                 gradient_checkpointing: bool = False,
+                 model: nn.Module = None,
+                 log_every: int = None,
                  **kwargs):
         """Trains the CA model
 
@@ -125,9 +305,11 @@ class CAModel(nn.Module):
                 Defaults to 2, i.e. substitute the image with maximum loss
                 every 2 iterations.
 
-            evolution_iters (Tuple[int, int], optional):
-                Minimum and maximum number of evolution iterations to perform.
-                Defaults to (50, 60).
+            evolution_iters (int, optional):
+                Number of evolution iterations to perform on each batch.
+                It is the same for every batch, so that the evolution has
+                a fixed trip count and the compiled step is graph-replayable.
+                Defaults to 96.
 
             kind (str, optional): 
                 Kind of CA to train, can be either one of:
@@ -147,37 +329,98 @@ class CAModel(nn.Module):
 
             stopping_criterion (StoppingCriteria, optional): Stopping criterion to use,
                 must inherit from StoppingCriteria and implement the method stop that throws a RuntimeException
+
+            mixed_precision (bool, optional): Whether to run the evolution under
+                bfloat16 autocast, the weights and the gradients stay in float32.
+                Defaults to False.
+
+            gradient_checkpointing (bool, optional): Whether to recompute the
+                evolution steps during the backward pass instead of storing
+                all of them, the memory grows with the square root of
+                evolution_iters instead of linearly, so larger batches fit.
+                Defaults to False.
+
+            model (nn.Module, optional): Module used for the forward pass,
+                e.g. a DistributedDataParallel wrapper of this CA.
+                Defaults to None i.e. the CA itself.
+
+            log_every (int, optional): Every how many epochs the losses are
+                sent to wandb and the progress is printed, the losses of the
+                epochs in between are buffered and sent together.
+                Defaults to None i.e. about 100 times during the training.
         """
 
         self.train()
 
+        device_type = torch.device(self.device).type
+        # with multiple processes only the first one logs
+        main_process = not dist.is_initialized() or dist.get_rank() == 0
+        # with DistributedDataParallel every process must do the same
+        # number of steps and take the same decisions on the epoch loss
+        distributed = isinstance(model, DistributedDataParallel)
+
+        # stream where the next batch is copied on the GPU while the current one is trained
+        copy_stream = None
+        if device_type == "cuda" and pool.device.type == "cpu":
+            copy_stream = torch.cuda.Stream(device=self.device)
+
+        # the kwargs used in the loops are read once
+        skip_damage = kwargs.get("skip_damage")
+        reset_prob = kwargs.get("reset_prob")
+
+        if log_every is None:
+            log_every = max(1, n_epochs // 100)
+        pending_logs = []  # epoch losses not yet sent to wandb
         for epoch in range(n_epochs):
-            epoch_losses = []  # array that stores the loss history
     
             #in some epochs we do a checkpoint where some operations are performed
             self.checkpoint(epoch)
     
-            # take the data
-            for j in range(pool.size // batch_size):        
-                inputs, indexes = pool.sample(batch_size)  # sample the inputs
-                # put them in the current device
-                inputs = inputs.to(self.device)
-                optimizer.zero_grad()  # reinitialize the gradient to zero
+            # take the data, the shards of the pool can differ by one image
+            if distributed:
+                n_batches = pool.size // dist.get_world_size() // batch_size
+            else:
+                n_batches = len(pool.all_indexes) // batch_size
+            # array that stores the loss history, kept on the device
+            epoch_losses = torch.zeros(n_batches, device=self.device)
+            next_batch = None
+            for j in range(n_batches):
+                if next_batch is None:
+                    next_batch = self._sample_batch(pool, batch_size, copy_stream)
+                inputs, indexes = next_batch  # sample the inputs
+                next_batch = None
+                # wait until they are in the current device
+                if copy_stream is not None:
+                    torch.cuda.current_stream().wait_stream(copy_stream)
+                    inputs.record_stream(torch.cuda.current_stream())
+                optimizer.zero_grad(set_to_none=True)  # drop the gradients, backward allocates them again
 
                 self.update(inputs)  # This is useful when you update the fixed mask
 
                 # recursive forward-pass
                 evolutions_per_image = pool.get_evolutions_per_image(indexes)
-                inputs, total_losses = self.loss_eval(inputs, criterion, evolution_iters, evolutions_per_image, epoch)
+                with torch.autocast(device_type, dtype=torch.bfloat16, enabled=mixed_precision):
+                    inputs, total_losses = self.loss_eval(inputs, criterion, evolution_iters,
+                                                          evolutions_per_image, epoch, model=model,
+                                                          gradient_checkpointing=gradient_checkpointing)
+
+                # with a copy stream the next batch is copied while this one runs on the GPU,
+                # it can't contain the images of this batch since they are updated in the
+                # pool later. Without one there is nothing to overlap, so it is sampled after
+                n_available = len(pool.all_indexes - pool.indexes_max_loss)
+                if copy_stream is not None and j + 1 < n_batches and n_available >= 2*batch_size:
+                    next_batch = self._sample_batch(pool, batch_size, copy_stream, exclude=indexes)
 
                 # We remove the worst performers, often times they degenerate and ruins everything
                 total_loss = torch.mean(total_losses[total_losses<5*total_losses.mean()])
                 total_loss.backward()
+                if normalize_gradients:
+                    self._normalize_gradients()
                 optimizer.step()
 
                 # customization of training for the three processes of growing. persisting and regenerating
                 # if regenerating, then damage inputs
-                if kind == "regenerating" and j % kwargs["skip_damage"] == 0:
+                if kind == "regenerating" and j % skip_damage == 0:
                     inputs = inputs.detach()
                     # damages the inputs by removing square portions
                     inputs = make_squares(inputs)
@@ -188,54 +431,191 @@ class CAModel(nn.Module):
 
                 # if training is not for growing process then re-insert trained/damaged samples into the pool
                 if kind != "growing":
-                    idx_max_loss = n_largest_indexes(total_losses, n_max_losses)
+                    idx_max_loss = None
+                    if n_max_losses > 0:
+                        k = min(n_max_losses, total_losses.numel())
+                        idx_max_loss = torch.topk(total_losses.detach(), k).indices.tolist()
                     pool.update(indexes, inputs, idx_max_loss, evolution_iters)
 
-                epoch_losses.append(total_loss.detach().cpu().item())
+                epoch_losses[j] = total_loss.detach()
 
             # if we have reset_prob in the kwargs then sometimes the pool resets
-            if kind!='growing' and 'reset_prob' in kwargs:
-                if np.random.uniform() < kwargs['reset_prob']:
+            if kind!='growing' and reset_prob is not None:
+                if np.random.uniform() < reset_prob:
                     pool.reset()
 
             # update the scheduler if there is one at all
             if scheduler is not None:
                 scheduler.step()
 
-            # Log epoch losses
-            epoch_loss = np.mean(epoch_losses)
-
-            # Stopping criteria
-            stopping_criterion.stop(epoch, epoch_loss)
+            # Log epoch losses, synchronizing with the device once per epoch
+            epoch_loss = epoch_losses.mean()
+            if distributed:
+                dist.all_reduce(epoch_loss)
+                epoch_loss /= dist.get_world_size()
+            epoch_loss = epoch_loss.item()
+
+            # Stopping criteria, the buffered losses are logged before stopping
+            try:
+                stopping_criterion.stop(epoch, epoch_loss)
+            except Exception:
+                if main_process:
+                    self._log_losses(pending_logs)
+                raise
 
-            wandb.log({"loss": epoch_loss})
             self.losses.append(epoch_loss)
-            print(f"epoch: {epoch + 1}\navg loss: {epoch_loss}")
-            clear_output(wait=True)
+            if main_process:
+                pending_logs.append(epoch_loss)
+                if (epoch + 1) % log_every == 0:
+                    self._log_losses(pending_logs)
+                    print(f"epoch: {epoch + 1}\navg loss: {epoch_loss}")
+                    clear_output(wait=True)
+
+        if main_process:
+            self._log_losses(pending_logs)
+
+    @staticmethod
+    def _log_losses(pending_logs: List[float]):
+        """Sends the buffered epoch losses to wandb and empties the buffer"""
+        for epoch_loss in pending_logs:
+            wandb.log({"loss": epoch_loss})
+        pending_logs.clear()
+
+    def _normalize_gradients(self):
+        """Divides the gradient of each parameter by its norm, all the gradients
+        are normalized together with the multi-tensor foreach kernels"""
+        grads = [param.grad for param in self.parameters() if param.grad is not None]
+        if len(grads) == 0:
+            return
+        norms = torch._foreach_norm(grads)
+        torch._foreach_add_(norms, 1e-8)
+        torch._foreach_div_(grads, norms)
+
+    def _sample_batch(self, pool: SamplePool, batch_size: int,
+                      copy_stream: torch.cuda.Stream = None,
+                      exclude: List[int] = ()) -> Tuple[torch.Tensor, List[int]]:
+        """Samples a batch from the pool and moves it on the device, if copy_stream
+        is given the copy is asynchronous and is enqueued on copy_stream"""
+        inputs, indexes = pool.sample(batch_size, exclude, pin_memory=copy_stream is not None)
+        if copy_stream is None:
+            return inputs.to(self.device), indexes
+
+        with torch.cuda.stream(copy_stream):
+            inputs = inputs.to(self.device, non_blocking=True)
+        return inputs, indexes
+
+    def train_CA_ddp(self,
+                     optimizer: torch.optim.Optimizer,
+                     criterion: Callable[[torch.Tensor, Any], torch.Tensor],
+                     pool: SamplePool,
+                     n_epochs: int,
+                     backend: str = "nccl",
+                     **kwargs):
+        """Trains the CA model on multiple GPUs with DistributedDataParallel,
+        must be run with one process per GPU, e.g. with torchrun.
+        Each process trains on its own shard of the pool and the gradients
+        are averaged between the processes at each optimizer step.
+
+        Args:
+            optimizer (torch.optim.Optimizer): Optimizer to use, recommended Adam
+            criterion (Callable[[torch.Tensor], Tuple[torch.Tensor,torch.Tensor]]): Loss function to use
+            pool (SamplePool): Sample pool from which to extract the images
+            n_epochs (int): Number of epochs to perform
+            backend (str, optional): Backend of the process group. Defaults to "nccl".
+            kwargs: Other arguments of train_CA
+        """
+        # the CAs that keep their rules in plain lists, like MultipleCA,
+        # have no registered parameters for DistributedDataParallel to synchronize
+        if len(list(self.parameters())) == 0:
+            raise ValueError(f"{type(self).__name__} has no registered parameters, "
+                             "it can't be trained with train_CA_ddp")
+
+        if not dist.is_initialized():
+            dist.init_process_group(backend)
+        local_rank = int(os.environ.get("LOCAL_RANK", 0))
+
+        # move the CA, and any CA it contains, on the GPU of this process
+        torch.cuda.set_device(local_rank)
+        device = torch.device("cuda", local_rank)
+        self.to(device)
+        for module in self.modules():
+            if isinstance(module, CAModel):
+                module.device = device
+
+        pool.shard(dist.get_rank(), dist.get_world_size())
+        # the buffers are constants, e.g. the Sobel filters, broadcasting them
+        # at each step would rewrite in place tensors saved for the backward pass
+        model = DistributedDataParallel(self, device_ids=[local_rank],
+                                        broadcast_buffers=False)
+
+        self.train_CA(optimizer, criterion, pool, n_epochs, model=model, **kwargs)
+
+
+    def loss_eval(self, inputs, criterion, evolution_iters, evolutions_per_image,epoch=0,log_losses=False,model=None,
+                  gradient_checkpointing=False):
+        if model is None:
+            model = self
+        inputs = inputs.contiguous(memory_format=torch.channels_last)
 
+        if log_losses==True:
+            # losses of each step, allocated on the device at the first step
+            # since its shape depends on the criterion
+            loss_per_step = None
+
+            for n_step in range(evolution_iters):
+                inputs = model(inputs)
+                params = self._loss_params(evolutions_per_image, n_step, evolution_iters, epoch, log_losses)
+                losses = criterion(inputs, **params)
+                if loss_per_step is None:
+                    loss_per_step = torch.empty((evolution_iters, *losses.shape),
+                                                dtype=losses.dtype, device=losses.device)
+                loss_per_step[n_step] = losses
+
+            return loss_per_step
+
+        # with gradient checkpointing only the states at the boundaries of chunks
+        # of about sqrt(evolution_iters) steps are kept for the backward pass,
+        # the steps inside each chunk are recomputed during the backward pass
+        chunk_size = evolution_iters
+        if gradient_checkpointing:
+            chunk_size = max(1, round(math.sqrt(evolution_iters)))
 
-    def loss_eval(self, inputs, criterion, evolution_iters, evolutions_per_image,epoch=0,log_losses=False):
         total_losses = torch.zeros(inputs.size()[0], device=self.device)
-        loss_per_step = []
-
-        for n_step in range(evolution_iters):
-            inputs = self.forward(inputs)
-            # calculate the loss of the inputs and return the ones with the biggest loss
-            params = {"start_iteration": evolutions_per_image,
-                        "current_iteration": evolutions_per_image + n_step,
-                        "end_iteration": evolutions_per_image + evolution_iters - 1,
-                        "n_epoch": epoch,
-                        "log_losses": log_losses}
-            losses = criterion(inputs, **params)
-            if log_losses==True:
-                loss_per_step.append(losses)
+        for start in range(0, evolution_iters, chunk_size):
+            chunk = (model, criterion, start, min(chunk_size, evolution_iters-start),
+                     evolution_iters, evolutions_per_image, epoch)
+            if gradient_checkpointing:
+                inputs, losses = torch.utils.checkpoint.checkpoint(
+                    self._evolve_chunk, inputs, *chunk, use_reentrant=False)
             else:
-                total_losses += losses
-        
-        if log_losses==True:
-            return torch.stack(loss_per_step)
+                inputs, losses = self._evolve_chunk(inputs, *chunk)
+            total_losses += losses
+
+        params = self._loss_params(evolutions_per_image, evolution_iters-1, evolution_iters, epoch, log_losses)
         return inputs, total_losses + self.end_step_loss(inputs, **params)
 
+    def _evolve_chunk(self, inputs, model, criterion, start, n_steps,
+                      evolution_iters, evolutions_per_image, epoch):
+        """Evolves the inputs for n_steps starting from step start,
+        returns the new inputs and the sum of the losses"""
+        total_losses = 0.
+        for n_step in range(start, start+n_steps):
+            inputs = model(inputs)
+            # calculate the loss of the inputs and return the ones with the biggest loss
+            params = self._loss_params(evolutions_per_image, n_step, evolution_iters, epoch, False)
+            total_losses = total_losses + criterion(inputs, **params)
+
+        return inputs, total_losses
+
+    @staticmethod
+    def _loss_params(evolutions_per_image, n_step, evolution_iters, epoch, log_losses):
+        """Returns the keyword arguments given to the criterion at step n_step"""
+        return {"start_iteration": evolutions_per_image,
+                "current_iteration": evolutions_per_image + n_step,
+                "end_iteration": evolutions_per_image + evolution_iters - 1,
+                "n_epoch": epoch,
+                "log_losses": log_losses}
+
     #These functions are to be defined in the child classes    
     def update(self, x):
         return
@@ -91,16 +91,16 @@ class MultipleCA(CAModel):
         # Apply updates all at once or one at a time randomly/sequentially?
         # Currently applies only a global mask and all updates at once
 
-        #calculate the mask of each channel
+        #calculate the mask of each channel, cast to float only once
         update_mask = multiple_living_mask(x[:, self.n_channels:]).float()
-        #calculate the global mask
-        pre_life_mask = update_mask.max(dim=1, keepdim=True)[0]
+        #calculate the global mask, amax doesn't compute the indices of the maximum
+        pre_life_mask = update_mask.amax(dim=1, keepdim=True)
             
-        #apply the mask to the input tensor
-        x[:, self.n_channels:] = x[:, self.n_channels:] * update_mask
-
-        #set to zero every cell that is dead
-        x = x * pre_life_mask
+        #apply the mask to the alphas and set to zero every cell that is dead,
+        #the alphas are already zero where the cell is dead so each channel is
+        #masked once, out of place so that the input of the step is left untouched
+        x = torch.cat((x[:, :self.n_channels] * pre_life_mask,
+                       x[:, self.n_channels:] * update_mask), dim=1)
 
         #create the updates tensor
         updates = torch.empty([self.n_CAs, *x.shape], device=self.device)
@@ -108,7 +108,7 @@ class MultipleCA(CAModel):
             updates[i] = CA.compute_dx(x, angle, step_size)
 
         update_mask=update_mask/(1e-8 + update_mask.sum(dim=1,keepdim=True))
-        update_mask[torch.isnan(update_mask)]=0
+        update_mask=torch.nan_to_num(update_mask, nan=0.)
         
         #The sum of all updates is the total update
         updates = torch.einsum("Abchw, bAhw -> bchw", updates, update_mask)
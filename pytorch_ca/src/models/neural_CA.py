@@ -1,3 +1,4 @@
+import math
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -8,15 +9,53 @@ from ..sample_pool import *
 from .CAModel import *
 
 
+def _is_compiling() -> bool:
+    """Returns True while torch.compile is tracing the code"""
+    compiler = getattr(torch, "compiler", None)
+    return compiler is not None and hasattr(compiler, "is_compiling") \
+        and compiler.is_compiling()
+
+
+def _update_state_eager(x: torch.Tensor, dx: torch.Tensor,
+                        alpha_channel: int) -> torch.Tensor:
+    """Adds the update dx to the CA state x and applies the living mask,
+    kept in a single function so that its elementwise tail can be fused
+
+    Args:
+        x (torch.Tensor): Previous CA state
+        dx (torch.Tensor): Update of the state
+        alpha_channel (int): Channel used to compute the living mask
+
+    Returns:
+        torch.Tensor: Next CA state
+    """
+    pre_life_mask = alpha_living_mask(x[:, alpha_channel:alpha_channel+1])
+
+    x = x + dx
+
+    post_life_mask = alpha_living_mask(x[:, alpha_channel:alpha_channel+1])
+
+    # return updated states with alive masking, x is a new tensor here
+    # so it can be masked in place with the boolean mask
+    return x.mul_(pre_life_mask & post_life_mask)
+
+
+# Scripted once at import, torch.compile traces the eager version instead
+_update_state = torch.jit.script(_update_state_eager)
+
 
 class NeuralCA(CAModel):
     """Implements a neural cellular automata model like described here
     https://distill.pub/2020/growing-ca/
     """
 
+    # Number of steps whose fire masks are drawn at once outside of autograd
+    fire_mask_steps = 8
+
     def __init__(self, n_channels: int = 16,
                  device: torch.device = None,  # ma non è inutile questo argomento?
-                 fire_rate: float = 0.5):
+                 fire_rate: float = 0.5,
+                 compile_step: bool = False):
         """Initializes the network.
 
         Args:
@@ -26,6 +65,10 @@ class NeuralCA(CAModel):
                 Defaults to None.
             fire_rate (float, optional): Probability to reject an update.
                 Defaults to 0.5.
+            compile_step (bool, optional): Whether to compile the update step
+                with torch.compile, this fuses the small kernels of a step,
+                specialized for the input shape, and replays them with
+                CUDA graphs. Defaults to False.
         """
 
         super().__init__(n_channels,device,fire_rate)
@@ -33,7 +76,7 @@ class NeuralCA(CAModel):
         # Network layers needed for the update rule
         self.layers = nn.Sequential(
             nn.Conv2d(n_channels*3, 128, 1),
-            nn.ReLU(),
+            nn.ReLU(inplace=True),
             nn.Conv2d(128, n_channels, 1))
 
         # Set the parameters of the second layer to zero
@@ -41,8 +84,42 @@ class NeuralCA(CAModel):
             if "2" in name:
                 param.data.zero_()
 
+        # The states are evolved in channels_last, which gives the 1x1
+        # convolutions the faster NHWC kernels
+        self.layers = self.layers.to(memory_format=torch.channels_last)
+
+        # Sobel filters, built once and reused at every step, the identity
+        # filter is not needed since it just copies the cells
+        dx = torch.tensor([[-0.125, 0., 0.125],
+                           [-0.25, 0., 0.25],
+                           [-0.125, 0., 0.125]])
+        dy = dx.T
+        all_filters = torch.stack((dx, dy))
+        all_filters_batch = all_filters.repeat(n_channels, 1, 1).unsqueeze(1)
+        all_filters_batch = all_filters_batch.contiguous(memory_format=torch.channels_last)
+
+        # Not persistent, so that the pretrained state dicts still load
+        self.register_buffer("perceive_filters", all_filters_batch,
+                             persistent=False)
+        # Rotated filters of each angle used so far, built once and never
+        # rewritten, so that the CUDA graphs captured with an angle keep
+        # reading the filters of that angle
+        self._rot_filters = {}
+
+        # Fire masks of the next steps, see _fire_mask
+        self._fire_buf = None
+        self._fire_idx = 0
+
         self.to(device)
 
+        # The first calls are slow since they compile the step, the step is
+        # specialized on the shapes it sees since a CA is run on few grid sizes
+        self._compiled_step = None
+        if compile_step:
+            self._compiled_step = torch.compile(self._forward_impl,
+                                                mode="reduce-overhead",
+                                                dynamic=False)
+
     def perceive(self, images: torch.Tensor, angle: float = 0.) -> torch.Tensor:
         """Returns the perception vector of each cell in an image, or perception matrix
 
@@ -54,28 +131,44 @@ class NeuralCA(CAModel):
             torch.Tensor: Perception matrix
         """
 
-        # Filters
-        identity = torch.tensor([[0., 0., 0.],
-                                 [0., 1., 0.],
-                                 [0., 0., 0.]])
-        dx = torch.tensor([[-0.125, 0., 0.125],
-                           [-0.25, 0., 0.25],
-                           [-0.125, 0., 0.125]])
-        dy = dx.T
+        if angle == 0.:
+            filters = self.perceive_filters
+        else:
+            filters = self._rotated_filters(float(angle))
+
+        # Depthwise convolution over input images
+        gradients = F.conv2d(wrap_edges(images), filters, groups=self.n_channels)
 
-        # Rotation
-        angle = torch.tensor(angle)
-        c, s = torch.cos(angle), torch.sin(angle)
-        dx, dy = c*dx - s*dy, s*dx + c*dy
+        # Interleave each cell with its gradients, i.e. the channels are
+        # (cell, dx, dy) for each input channel as with an identity filter.
+        # Done in NHWC so that the result is already channels_last
+        b, c, h, w = images.size()
+        cells = images.permute(0, 2, 3, 1).reshape(b, h, w, c, 1)
+        gradients = gradients.permute(0, 2, 3, 1).reshape(b, h, w, c, 2)
+        perception = torch.cat((cells, gradients), dim=-1)
+        return perception.reshape(b, h, w, 3*c).permute(0, 3, 1, 2)
 
-        # Create filters batch
-        all_filters = torch.stack((identity, dx, dy))
-        all_filters_batch = all_filters.repeat(
-            self.n_channels, 1, 1).unsqueeze(1)
-        all_filters_batch = all_filters_batch.to(self.device)
+    def _rotated_filters(self, angle: float) -> torch.Tensor:
+        """Returns the Sobel filters rotated by angle
 
-        # Depthwise convolution over input images
-        return F.conv2d(wrap_edges(images), all_filters_batch, groups=self.n_channels)
+        Args:
+            angle (float): Angle of the Sobel filters
+
+        Returns:
+            torch.Tensor: Rotated perception filters
+        """
+        filters = self._rot_filters.get(angle)
+        if filters is None or filters.device != self.perceive_filters.device \
+                or filters.dtype != self.perceive_filters.dtype:
+            c, s = math.cos(angle), math.sin(angle)
+            dx, dy = self.perceive_filters[0::2], self.perceive_filters[1::2]
+
+            filters = torch.empty_like(self.perceive_filters)
+            filters[0::2].copy_(dx).mul_(c).add_(dy, alpha=-s)
+            filters[1::2].copy_(dx).mul_(s).add_(dy, alpha=c)
+            self._rot_filters[angle] = filters
+
+        return filters
 
     def compute_dx(self, x: torch.Tensor, angle: float = 0.,
                    step_size: float = 1.) -> torch.Tensor:
@@ -89,14 +182,44 @@ class NeuralCA(CAModel):
         Returns:
             torch.Tensor: dx
         """
-        # compute update increment
-        dx = self.layers(self.perceive(x, angle)) * step_size
+        # compute update increment, the default step size needs no multiplication
+        dx = self.layers(self.perceive(x, angle))
+        if step_size != 1.:
+            dx = dx * step_size
 
-        # get random-per-cell mask for stochastic update
-        update_mask = torch.rand(
-            x[:, :1, :, :].size(), device=self.device) < self.fire_rate
+        # get random-per-cell mask for stochastic update, dx is a new
+        # tensor so it is masked in place instead of allocating another one
+        return dx.mul_(self._fire_mask(x))
 
-        return dx*update_mask.float()
+    def _fire_mask(self, x: torch.Tensor) -> torch.Tensor:
+        """Returns the random-per-cell mask of the stochastic update.
+        Outside of autograd the masks of the next fire_mask_steps steps
+        are drawn at once, in a single kernel, and consumed one per call.
+
+        Args:
+            x (torch.Tensor): Previous CA state, only used to take the shape
+
+        Returns:
+            torch.Tensor: Float mask that is 1 where the cell is updated
+        """
+        shape = x[:, :1, :, :].size()
+
+        # Under autograd, compilation or CUDA graph capture draw a new mask,
+        # a stateful buffer would not be replayed correctly there
+        if torch.is_grad_enabled() or _is_compiling() or \
+                (x.is_cuda and torch.cuda.is_current_stream_capturing()):
+            return (torch.rand(shape, device=self.device) < self.fire_rate).float()
+
+        if self._fire_buf is None or self._fire_idx == len(self._fire_buf) \
+                or self._fire_buf.shape[1:] != shape \
+                or self._fire_buf.device != x.device:
+            self._fire_buf = torch.empty((self.fire_mask_steps, *shape),
+                                         device=x.device).bernoulli_(self.fire_rate)
+            self._fire_idx = 0
+
+        mask = self._fire_buf[self._fire_idx]
+        self._fire_idx += 1
+        return mask
 
     def forward(self, x: torch.Tensor,
                 angle: float = 0.,
@@ -111,17 +234,19 @@ class NeuralCA(CAModel):
         Returns:
             torch.Tensor: Next CA state
         """
-        pre_life_mask = get_living_mask(x,3)
-
-        x = x + self.compute_dx(x, angle, step_size)
-
-        post_life_mask = get_living_mask(x,3)
+        if self._compiled_step is not None:
+            return self._compiled_step(x, angle, step_size)
+        return self._forward_impl(x, angle, step_size)
 
-        # get alive mask
-        life_mask = pre_life_mask & post_life_mask
+    def _forward_impl(self, x: torch.Tensor,
+                      angle: float = 0.,
+                      step_size: float = 1.) -> torch.Tensor:
+        """Body of forward, kept apart so that it can be compiled"""
+        dx = self.compute_dx(x, angle, step_size)
 
-        # return updated states with alive masking
-        return x * life_mask.float()
+        if _is_compiling():
+            return _update_state_eager(x, dx, 3)
+        return _update_state(x, dx, 3)
 
     def load(self, fname: str):
         """Loads a (pre-trained) model
@@ -130,7 +255,11 @@ class NeuralCA(CAModel):
             fname (str): Path of the model to load
         """
 
-        self.load_state_dict(torch.load(fname))
+        # the file is memory mapped and only the tensors are unpickled, they
+        # are copied in the existing parameters that keep their memory format
+        state_dict = torch.load(fname, map_location=self.device,
+                                mmap=True, weights_only=True)
+        self.load_state_dict(state_dict)
         print("Successfully loaded model!")
 
     def save(self, fname: str, overwrite: bool = False):
@@ -80,4 +80,5 @@ class VirusCA(CAModel):
 
         x_old = self.old_CA(x, angle, step_size)
         x_new = self.new_CA(x, angle, step_size)
-        return x_old * self.old_cells + x_new * self.new_cells
\ No newline at end of file
+        # same as x_old*old_cells + x_new*new_cells, in a single kernel
+        return torch.lerp(x_old, x_new, self.new_cells.to(x_old.dtype))
\ No newline at end of file
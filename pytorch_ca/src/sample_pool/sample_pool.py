@@ -88,21 +88,46 @@ class SamplePool(Dataset):
         """
         self.images = transform(self.images)
 
-    def sample(self, batch_size: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    def shard(self, rank: int, world_size: int):
+        """Restricts the sampling to the images of the given shard of the pool,
+        useful to train on multiple processes without overlapping samples
+
+        Args:
+            rank (int): Index of the shard
+            world_size (int): Number of shards
+        """
+        self.all_indexes = set(range(rank, self.size, world_size))
+
+    def sample(self, batch_size: int,
+               exclude: Iterable[int] = (),
+               pin_memory: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
         """Samples from the pool batch_size images and returns them,
         along with the corresponding indexes
 
         Args:
             batch_size (int): Number of images to extract
+            exclude (Iterable[int], optional): Indexes that must not be sampled,
+                e.g. the ones of a batch that is not yet updated in the pool.
+                Defaults to ().
+            pin_memory (bool, optional): Whether to return the images in
+                pinned memory, so that they can be copied asynchronously
+                on the GPU, only used if the pool is on the CPU.
+                Defaults to False.
 
         Returns:
             Tuple[torch.Tensor, torch.Tensor]:
                 The extraxted images,
                 the corresponding indexes in the sample pool
         """
-        idx = random.sample(self.all_indexes -
-                            self.indexes_max_loss, batch_size)
-        return self.transform(self.images[idx]).clone(), idx
+        # random.sample needs a sequence since python 3.11
+        idx = random.sample(tuple(self.all_indexes - self.indexes_max_loss -
+                                  set(exclude)), batch_size)
+        images = self.transform(self.images[idx])
+        if pin_memory and images.device.type == "cpu":
+            # a single copy straight into pinned memory instead of clone + pin_memory
+            pinned = torch.empty(images.size(), dtype=images.dtype, pin_memory=True)
+            return pinned.copy_(images), idx
+        return images.clone(), idx
 
     def replace(self, indexes: List[int]) -> None:
         """Replaces images at indexes "indexes" of the pool with new_images
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 
 import torchvision.transforms as T
 from torchvision.utils import save_image
@@ -176,6 +177,9 @@ class tensor_to_RGB():
         """
         self.rescaling = rescaling
         self.function = function
+        # the builtin functions color each pixel on its own, so the image
+        # is colored at the CA resolution and rescaled afterwards
+        self.pixelwise = False
 
         if function == 'RGBA':
             if CA == None:
@@ -183,14 +187,17 @@ class tensor_to_RGB():
                     'If the function is "RGBA" you must specify the CA rule')
             self.CA = CA
             self.function = self.RGBA
+            self.pixelwise = True
 
         if type(function) == int:
             self.channel = function
             self.function = self.gray
+            self.pixelwise = True
 
         if type(function) == list and len(function) == 2 and type(function[0])==int:
             self.channel = function
             self.function = self.two
+            self.pixelwise = True
 
     def __call__(self, tensor: torch.Tensor):
         """Converts a tensor to RGB
@@ -201,14 +208,17 @@ class tensor_to_RGB():
         Returns:
             torch.Tensor: with shape (3,image_size*rescaling,image_size*rescaling)
         """
-        video_size = tensor.size()[-1] * self.rescaling
-        rescaler = T.Resize((video_size, video_size),
-                            interpolation=T.InterpolationMode.NEAREST)
-        tensor = rescaler(tensor)
-        return self.function(tensor)
+        if not self.pixelwise:
+            tensor = F.interpolate(tensor, scale_factor=self.rescaling, mode="nearest")
+            return self.function(tensor)
+
+        image = self.function(tensor)
+        image = image.reshape(1, 3, *image.size()[-2:])
+        return F.interpolate(image, scale_factor=self.rescaling, mode="nearest")[0]
 
     def RGBA(self, tensor):
-        return RGBAtoRGB(tensor, self.CA.alpha_channel)[0].cpu()
+        # stays on the device of the tensor, make_video copies it asynchronously
+        return RGBAtoRGB(tensor, self.CA.alpha_channel)[0]
 
     def gray(self, tensor):
         return GrayscaletoCmap(tensor[0, self.channel])
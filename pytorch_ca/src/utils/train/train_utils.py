@@ -23,7 +23,9 @@ def wrap_edges(images: torch.Tensor) -> torch.Tensor:
     Returns:
         torch.Tensor: Padded images
     """
-    return F.pad(images, pad=(1, 1, 1, 1), mode='circular', value=0)
+    # A single circular pad kernel, writing the interior and the four
+    # borders into a persistent buffer would take five copy kernels
+    return F.pad(images, pad=(1, 1, 1, 1), mode='circular')
 
 
 def get_living_mask(images: torch.Tensor, channels: List[int]) -> torch.Tensor:
@@ -38,10 +40,22 @@ def get_living_mask(images: torch.Tensor, channels: List[int]) -> torch.Tensor:
     """
     if isinstance(channels, int):
         channels = [channels]
-    alpha = images[:, channels, :, :]
+    return alpha_living_mask(images[:, channels, :, :])
 
+
+def alpha_living_mask(alpha: torch.Tensor) -> torch.Tensor:
+    """Returns the mask of the living cells given their alpha channels,
+    it can be called from scripted functions
+
+    Args:
+        alpha (torch.Tensor): alpha channels of the images
+
+    Returns:
+        torch.Tensor: Living mask
+    """
     neighbors = F.max_pool2d(wrap_edges(alpha), 3, stride=1) > 0.1
-    return torch.max(neighbors, dim=1, keepdim=True)[0]
+    # any doesn't compute the int64 indices of the maximum like torch.max
+    return neighbors.any(dim=1, keepdim=True)
 
 
 def multiple_living_mask(alphas: torch.Tensor):
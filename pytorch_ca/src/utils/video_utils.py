@@ -7,6 +7,21 @@ from .utils import *
 from .image_utils import *
 
 
+# Number of pinned frames that make_video stages the GPU frames through
+_staging_frames = 3
+
+
+def _flush_staging(video, staging, pending, slot):
+    """Waits for the copy into the staging frame slot, if there is one,
+    and moves the frame into its place in the video"""
+    if pending[slot] is None:
+        return
+    event, k, i = pending[slot]
+    event.synchronize()
+    video[k][i] = staging[slot]
+    pending[slot] = None
+
+
 def make_video(CA: "CAModel",
                n_iters: int,
                init_state: torch.Tensor = None,
@@ -15,6 +30,8 @@ def make_video(CA: "CAModel",
                fps: int = 10,
                initial_video: torch.Tensor = None,
                converter: callable = None,
+               graphed: bool = False,
+               dtype: torch.dtype = None,
                **kwargs) -> torch.Tensor:
     """Returns the video (torch.Tensor of size (n_iters, init_state.size()))
         of the evolution of the CA starting from a given initial state
@@ -35,12 +52,19 @@ def make_video(CA: "CAModel",
         converter (callable, optional):
             function that converts the torch.Tensor of the state to an image.
             Defaults to RGBAtoRGB
+        graphed (bool, optional): Whether to replay each step of the CA
+            as a CUDA graph, see CAModel.evolve_graphed, only used on the GPU.
+            Defaults to False.
+        dtype (torch.dtype, optional): Lower precision dtype to run the
+            update network in, e.g. torch.bfloat16, see CAModel.evolve.
+            Defaults to None i.e. full precision.
     """
     # create the initial state in case there is none
     if init_state is None:
         n_channels = CA.n_channels
         init_state = make_seed(1, n_channels-1, 48, alpha_channel=3)
-    init_state = init_state.to(CA.device)
+    # evolved in channels_last like in evolve and in training
+    init_state = init_state.to(CA.device).contiguous(memory_format=torch.channels_last)
 
     # create the converter if there is none
     if converter==None:
@@ -55,29 +79,59 @@ def make_video(CA: "CAModel",
 
     # set video visualization features
     video_size = init_state.size()[-1] * converter[0].rescaling
-    video = [torch.empty((n_iters, 3, video_size, video_size),
-                         device="cpu") for _ in range(l)]
+    video = [torch.empty((n_iters, 3, video_size, video_size), device="cpu")
+             for _ in range(l)]
+
+    # on the GPU the frames are copied on a separate stream into a small ring
+    # of pinned staging frames, so that the copies overlap with the evolution,
+    # and then into the video, which stays in pageable memory however long it is
+    copy_stream = None
+    if init_state.is_cuda:
+        copy_stream = torch.cuda.Stream(device=init_state.device)
+        staging = [torch.empty((3, video_size, video_size), pin_memory=True)
+                   for _ in range(_staging_frames)]
+        # event of the copy in each staging frame and where it goes in the video
+        pending = [None] * _staging_frames
+        n_copies = 0
 
     # this manages the kwargs necessary for the regenerating case
     if regenerating:
-        target_size = None
-        constant_side = None
-        if 'target_size' in kwargs:
-            target_size = kwargs['target_size']
-        if 'constant_side' in kwargs:
-            constant_side = kwargs['constant_side']
+        target_size = kwargs.get('target_size')
+        constant_side = kwargs.get('constant_side')
 
     # evolution
-    with torch.no_grad():
+    device_type = init_state.device.type
+    with torch.no_grad(), torch.autocast(device_type, dtype=dtype, enabled=dtype is not None):
         for i in range(n_iters):
             for k in range(l):
-                video[k][i] = converter[k](init_state)
-            init_state = CA.forward(init_state)
+                frame = converter[k](init_state)
+                if copy_stream is None or not frame.is_cuda:
+                    video[k][i] = frame
+                    continue
+                slot = n_copies % _staging_frames
+                n_copies += 1
+                _flush_staging(video, staging, pending, slot)
+                copy_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(copy_stream):
+                    staging[slot].copy_(frame, non_blocking=True)
+                    event = torch.cuda.Event()
+                    event.record(copy_stream)
+                frame.record_stream(copy_stream)
+                pending[slot] = (event, k, i)
+            if graphed and init_state.is_cuda:
+                init_state = CA.evolve_graphed(init_state, 1, dtype=dtype)
+            else:
+                init_state = CA.forward(init_state)
 
             if regenerating and i == n_iters//3:
                 init_state = make_squares(
                     init_state, target_size, constant_side=constant_side)
 
+        # wait for the last frames to be copied
+        if copy_stream is not None:
+            for slot in range(_staging_frames):
+                _flush_staging(video, staging, pending, slot)
+
     # this concatenates the new video with the old one
     if initial_video is not None:
         if type(initial_video) is not list: